@@ -0,0 +1,49 @@
+from datetime import timedelta
+import os
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from subliminal import region
+
+from .mutexlock import MutexLock
+
+#: Environment variable with the url of a shared cache, e.g. ``redis://localhost:6379/0``
+CACHE_URL_ENV = 'SUBLIMINAL_CACHE_URL'
+
+EXPIRATION_TIME = timedelta(days=30)
+
+
+def configure_region():
+    """Configure the subliminal cache region, unless it is already configured.
+
+    The backend is selected by the url in :data:`CACHE_URL_ENV`: ``redis://`` and ``memcached://`` urls use
+    these servers with their own per-key locks, ``memory://`` keeps the cache in process. Without url, the cache is
+    kept in a dbm file guarded by a :class:`~.mutexlock.MutexLock`.
+    """
+    if region.is_configured:
+        return
+
+    url = os.environ.get(CACHE_URL_ENV)
+    if not url:
+        region.configure('dogpile.cache.dbm', expiration_time=EXPIRATION_TIME, arguments={'filename': 'subliminal.dbm', 'lock_factory': MutexLock})
+        return
+
+    scheme = urlparse(url).scheme
+    if scheme in ('redis', 'rediss'):
+        region.configure('dogpile.cache.redis', expiration_time=EXPIRATION_TIME, arguments={
+            'url': url,
+            'distributed_lock': True,
+            'redis_expiration_time': int(EXPIRATION_TIME.total_seconds())
+        })
+    elif scheme == 'memcached':
+        region.configure('dogpile.cache.pylibmc', expiration_time=EXPIRATION_TIME, arguments={
+            'url': urlparse(url).netloc.split(','),
+            'distributed_lock': True
+        })
+    elif scheme == 'memory':
+        region.configure('dogpile.cache.memory_pickle', expiration_time=EXPIRATION_TIME)
+    else:
+        raise ValueError('Unsupported cache url \'%s\' in %s!' % (url, CACHE_URL_ENV))
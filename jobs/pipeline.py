@@ -0,0 +1,88 @@
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+_DONE = object()
+
+
+class _Failure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def pipeline(source, func, workers, maxsize=0):
+    """Apply `func` to every item of `source` in `workers` threads and yield the results as they are ready.
+
+    `source` is consumed by a feeder thread into a queue of at most `maxsize` items, so results can be used while
+    `source` still produces items, and pipelines can be chained. Results are yielded in completion order and
+    ``None`` results are skipped. An exception raised by `source` or `func` is raised again by the generator.
+
+    When the generator ends, by exhaustion, by an exception or by being closed, it only returns once its threads
+    are done, so nothing is still running `func` afterwards. Pending items are skipped and `source` is closed.
+
+    :param source: iterable of items to process.
+    :param func: function to apply to each item.
+    :param int workers: number of worker threads.
+    :param int maxsize: maximum number of items waiting for a worker, unbounded if 0.
+    """
+    tasks = Queue(maxsize)
+    results = Queue()
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                tasks.put(item)
+        except Exception as e:
+            results.put(_Failure(e))
+        finally:
+            # stop and wait for chained pipelines as well
+            if hasattr(source, 'close'):
+                source.close()
+            for _ in range(workers):
+                tasks.put(_DONE)
+
+    def work():
+        try:
+            for item in iter(tasks.get, _DONE):
+                # keep draining after a stop so the feeder never blocks
+                if stop.is_set():
+                    continue
+                try:
+                    result = func(item)
+                except Exception as e:
+                    results.put(_Failure(e))
+                    continue
+                if result is not None:
+                    results.put(result)
+        finally:
+            results.put(_DONE)
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    done = 0
+    try:
+        while done < workers:
+            result = results.get()
+            if result is _DONE:
+                done += 1
+            elif isinstance(result, _Failure):
+                raise result.exception
+            else:
+                yield result
+    finally:
+        stop.set()
+        # drop the remaining results until every worker is done
+        while done < workers:
+            if results.get() is _DONE:
+                done += 1
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from subliminal import AsyncProviderPool
+
+logger = logging.getLogger(__name__)
+
+
+class LockingProviderPool(AsyncProviderPool):
+    """:class:`LockingProviderPool` is an :class:`~subliminal.core.AsyncProviderPool` that can be shared by threads.
+
+    Each provider is initialized under its own lock, and used by one thread at a time since provider instances and
+    their sessions are not thread-safe. Discarded providers are skipped when listing subtitles.
+    """
+    def __init__(self, *args, **kwargs):
+        super(LockingProviderPool, self).__init__(*args, **kwargs)
+        self.initialize_locks = {name: threading.Lock() for name in self.providers}
+        self.provider_locks = {name: threading.Lock() for name in self.providers}
+
+        #: providers whose listing failed, their session may have expired
+        self.failed_providers = set()
+
+    def __getitem__(self, name):
+        provider = self.initialized_providers.get(name)
+        if provider is not None:
+            return provider
+
+        # an unknown name fails here with a KeyError, like in the parent
+        with self.initialize_locks[name]:
+            return super(LockingProviderPool, self).__getitem__(name)
+
+    def __delitem__(self, name):
+        with self.initialize_locks[name]:
+            super(LockingProviderPool, self).__delitem__(name)
+
+    def initialize_providers(self):
+        """Initialize all providers that are not initialized nor discarded yet, discarding those that fail."""
+        for name in self.providers:
+            if name in self.discarded_providers:
+                continue
+            try:
+                self[name]
+            except Exception:
+                logger.exception('Error initializing provider %r', name)
+                self.discarded_providers.add(name)
+
+    def recycle_providers(self):
+        """Terminate discarded and failed providers, so they are initialized again on their next use."""
+        for name in self.discarded_providers | self.failed_providers:
+            if name in self.initialized_providers:
+                del self[name]
+        self.discarded_providers.clear()
+        self.failed_providers.clear()
+
+    def list_subtitles_provider(self, provider, video, languages):
+        # AsyncProviderPool.list_subtitles would initialize them again for every video
+        if provider in self.discarded_providers:
+            return provider, []
+
+        with self.provider_locks[provider]:
+            result = super(LockingProviderPool, self).list_subtitles_provider(provider, video, languages)
+
+        # errors are logged and swallowed, a listing of None is all that is left of them
+        if result[1] is None:
+            self.failed_providers.add(provider)
+        return result
+
+    def download_subtitle(self, subtitle):
+        with self.provider_locks[subtitle.provider_name]:
+            return super(LockingProviderPool, self).download_subtitle(subtitle)
@@ -1,5 +1,4 @@
 from __future__ import division
-from collections import defaultdict
 from datetime import timedelta, datetime
 from itertools import groupby
 import os
@@ -10,13 +9,13 @@ import hashlib
 from babelfish import Language
 
 from subliminal import (AsyncProviderPool, Episode, Movie, Video, check_video, get_scores,
-                        refine, region, save_subtitles, scan_videos)
+                        refine, save_subtitles, scan_videos)
 from subliminal.core import search_external_subtitles
 from subliminal.subtitle import get_subtitle_path
 
 from ndscheduler import job
 
-from .mutexlock import MutexLock
+from .cache import configure_region
 
 class ReportJob(job.JobBase):
     @classmethod
@@ -60,19 +59,17 @@ class ReportJob(job.JobBase):
         if not len(languages) >= 1:
             raise ValueError('\'languages\' list can\'t be empty!')
 
-        __tree_dict = lambda: defaultdict(__tree_dict)
-        result = __tree_dict()
+        result = {'videos': {}, 'meta': {}}
 
         age = timedelta(weeks=scan_age)
-        languages = set([Language(l) for l in languages])
+        languages = frozenset(Language(l) for l in languages)
 
         scan_start = datetime.now()
 
         videos = []
         ignored_videos = []
 
-        if not region.is_configured:
-            region.configure('dogpile.cache.dbm', expiration_time=timedelta(days=30), arguments={'filename': 'subliminal.dbm', 'lock_factory': MutexLock})
+        configure_region()
 
         # scan videos
         scanned_videos = scan_videos(scan_path, age=age)
@@ -89,9 +86,9 @@ class ReportJob(job.JobBase):
                 ignored_videos.append(video)
 
         if videos:
-            result['videos']['collected'] = [os.path.split(v.name)[1] for v in videos]
+            result['videos']['collected'] = [os.path.basename(v.name) for v in videos]
         if ignored_videos:
-            result['videos']['ignored'] = [os.path.split(v.name)[1] for v in ignored_videos]
+            result['videos']['ignored'] = [os.path.basename(v.name) for v in ignored_videos]
 
         scan_end = datetime.now()
         result['meta']['start'] = scan_start.isoformat()
@@ -1,17 +1,23 @@
 from __future__ import division
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta, datetime
-from itertools import groupby
+from itertools import chain
+import atexit
 import os
 import codecs
 import sys
 import hashlib
+import json
+import threading
 
 from babelfish import Language
+import requests
+from requests.adapters import HTTPAdapter
 from tinydb import TinyDB, Query
 
-from subliminal import (AsyncProviderPool, Episode, Movie, Video, check_video, get_scores,
-                        refine, region, save_subtitles, scan_videos)
+from subliminal import (Episode, Movie, Video, check_video, get_scores,
+                        refine)
 from subliminal.core import search_external_subtitles
 from subliminal.subtitle import get_subtitle_path
 
@@ -23,9 +29,73 @@ from ndscheduler import job
 
 import aeidon
 
-from .mutexlock import MutexLock
+from .cache import configure_region
+from .pipeline import pipeline
+from .providerpool import LockingProviderPool
+from .scanner import iter_videos
+from .uringwriter import batch_save_subtitles, open_subtitle_writer
+
+#: maximum number of videos searched on the providers at the same time
+MAX_PROVIDER_WORKERS = 8
+
+#: provider pools left idle for longer are terminated instead of reused, in minutes from SUBLIMINAL_POOL_MAX_IDLE
+POOL_MAX_IDLE = timedelta(minutes=int(os.environ.get('SUBLIMINAL_POOL_MAX_IDLE', 24 * 60)))
+
+#: normalized codec names, by requested encoding
+_ENCODING_CACHE = {}
+
+def _lookup_encoding(encoding):
+    if encoding not in _ENCODING_CACHE:
+        _ENCODING_CACHE[encoding] = codecs.lookup(encoding).name
+    return _ENCODING_CACHE[encoding]
+
+#: languages, by alpha3 code
+_LANGUAGE_CACHE = {}
+
+def _make_language(alpha3):
+    if alpha3 not in _LANGUAGE_CACHE:
+        _LANGUAGE_CACHE[alpha3] = Language(alpha3)
+    return _LANGUAGE_CACHE[alpha3]
+
+def _add_meta(result, scan_start):
+    scan_end = datetime.now()
+    result['meta']['start'] = scan_start.isoformat()
+    result['meta']['end'] = scan_end.isoformat()
+    result['meta']['duration'] = str(scan_end - scan_start)
+    return result
 
 class ScanJob(job.JobBase):
+    #: provider pools kept alive across runs, by (max_workers, providers, provider_configs)
+    _pool_cache = {}
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def lease_provider_pool(cls, max_workers, providers, provider_configs):
+        """Lease the cached provider pool for these arguments, concurrent runs share it."""
+        key = (max_workers, tuple(providers), json.dumps(provider_configs, sort_keys=True))
+        with cls._pool_lock:
+            lease = cls._pool_cache.setdefault(key, {'pool': None, 'used': None, 'leases': 0})
+            # provider sessions expire when left idle for too long
+            if lease['pool'] is not None and not lease['leases'] and datetime.now() - lease['used'] > POOL_MAX_IDLE:
+                lease['pool'].__exit__(None, None, None)
+                lease['pool'] = None
+            if lease['pool'] is None:
+                pool = LockingProviderPool(max_workers=max_workers, providers=providers, provider_configs=provider_configs)
+                lease['pool'] = pool.__enter__()
+            lease['leases'] += 1
+            pool = lease['pool']
+
+        try:
+            yield pool
+        finally:
+            with cls._pool_lock:
+                lease['leases'] -= 1
+                if not lease['leases']:
+                    # give discarded and failed providers a fresh session on the next run
+                    pool.recycle_providers()
+                    lease['used'] = datetime.now()
+
     @classmethod
     def get_scheduled_description(cls):
         return 'pid: %s' % (os.getpid(), )
@@ -44,7 +114,7 @@ class ScanJob(job.JobBase):
 
     @classmethod
     def get_succeeded_description(cls, result=None):
-        total = result['subtitles']['total'] if result['subtitles']['total'] else 0
+        total = result['subtitles'].get('total', 0)
         return 'pid: %s | downloaded: %s' % (os.getpid(), str(total))
 
     @classmethod
@@ -82,110 +152,186 @@ class ScanJob(job.JobBase):
         if not provider_configs:
             provider_configs = {}
 
-        __tree_dict = lambda: defaultdict(__tree_dict)
-        result = __tree_dict()
+        result = {'videos': {}, 'subtitles': {}, 'providers': {}, 'plex': {}, 'meta': {}}
 
-        encoding = codecs.lookup(encoding).name
+        # both are cached, bad arguments still fail every run
+        encoding = _lookup_encoding(encoding)
         age = timedelta(weeks=scan_age)
-        languages = set([Language(l) for l in languages])
-
-        plex = None
-        if plex_url and plex_token:
-            plex = PlexServer(plex_url, plex_token)
+        languages = frozenset(_make_language(l) for l in languages)
 
         scan_start = datetime.now()
 
+        # most runs find no new video, leave before setting anything else up
+        scanned_videos = iter_videos(scan_path, age=age)
+        first_video = next(scanned_videos, None)
+        if first_video is None:
+            return _add_meta(result, scan_start)
+
         videos = []
         ignored_videos = []
+        filenames = {}
 
-        if not region.is_configured:
-            region.configure('dogpile.cache.dbm', expiration_time=timedelta(days=30), arguments={'filename': 'subliminal.dbm', 'lock_factory': MutexLock})
+        configure_region()
 
-        # scan videos
-        scanned_videos = scan_videos(scan_path, age=age)
+        # scores only depend on the video type
+        min_scores = {}
 
-        for video in scanned_videos:
+        def add_external_subtitles(video):
             video.subtitle_languages |= set(search_external_subtitles(video.name).values())
+            return video
+
+        def refine_video(video):
             if check_video(video, languages=languages, age=age, undefined=False):
                 refine(video)
-                if languages - video.subtitle_languages:
+                needed_languages = languages - video.subtitle_languages
+                if needed_languages:
+                    filenames[video] = os.path.basename(video.name)
                     videos.append(video)
-                else:
-                    ignored_videos.append(video)
-            else:
-                ignored_videos.append(video)
+                    return video, needed_languages
+            ignored_videos.append(video)
+
+        def download_video_subtitles(item):
+            video, needed_languages = item
+            if type(video) not in min_scores:
+                min_scores[type(video)] = get_scores(video)['hash'] * min_score / 100
+            subtitles = p.list_subtitles(video, needed_languages)
+            return video, p.download_best_subtitles(subtitles, video, languages, min_score=min_scores[type(video)])
+
+        def initialize_providers(refined_videos):
+            # runs in the feeder thread of the provider stage, logs in only once a video needs subtitles
+            for i, item in enumerate(refined_videos):
+                if not i:
+                    p.initialize_providers()
+                yield item
+
+        def filter_subtitles(downloads, table):
+            # runs in the feeder thread of the save stage, the only one using the database
+            query = Query()
+            for video, subtitles in downloads:
+                discarded_subtitles = list()
+                discarded_subtitles_info = list()
+
+                for s in subtitles:
+                    subtitle_hash = hashlib.sha256(s.content).hexdigest()
+                    subtitle_file = get_subtitle_path(filenames[video], s.language)
+                    dbo = {'hash': subtitle_hash, 'file': subtitle_file}
+                    if table.search((query.hash == subtitle_hash) & (query.file == subtitle_file)):
+                        discarded_subtitles.append(s)
+                        discarded_subtitles_info.append(dbo)
+                    else:
+                        table.insert(dbo)
+
+                subtitles = [x for x in subtitles if x not in discarded_subtitles]
+                if discarded_subtitles_info:
+                    result['subtitles'].setdefault('discarded', []).extend(discarded_subtitles_info)
+                if subtitles:
+                    yield video, subtitles
+
+        def save_video_subtitles(item):
+            video, subtitles = item
+            # nothing reads the files before the end of the run, the writer flushes once a ring's worth is pending
+            return video, batch_save_subtitles({video: subtitles}, directory=None, encoding=encoding, writer=writer, flush=False)[video]
+
+        # scan, refine, download best subtitles, filter and save them, each stage starts with the first video
+        saved_subtitles = {}
+        with self.lease_provider_pool(max_workers, providers, provider_configs) as p:
+            # one io_uring writer for the whole run, used by the single save worker and flushed once the stage is done
+            writer = open_subtitle_writer()
+            try:
+                with TinyDB('subtitle_db.json') as db:
+                    # directory listings of external subtitles are slow on network shares, run many at once
+                    scanned_videos = pipeline(chain([first_video], scanned_videos), add_external_subtitles, max_workers, maxsize=max_workers * 2)
+                    refined_videos = pipeline(scanned_videos, refine_video, max(1, max_workers // 2), maxsize=max_workers * 2)
+                    # few provider workers with a long queue, many concurrent connections get rate limited
+                    downloads = pipeline(initialize_providers(refined_videos), download_video_subtitles, min(max_workers, MAX_PROVIDER_WORKERS), maxsize=max_workers * 4)
+                    for video, subtitles in pipeline(filter_subtitles(downloads, db.table('downloaded')), save_video_subtitles, 1):
+                        saved_subtitles[video] = subtitles
+                    if writer is not None:
+                        writer.flush()
+
+                if p.discarded_providers:
+                    result['providers']['discarded'] = list(p.discarded_providers)
+            finally:
+                if writer is not None:
+                    writer.close()
 
         if videos:
-            result['videos']['collected'] = [os.path.split(v.name)[1] for v in videos]
+            result['videos']['collected'] = [filenames[v] for v in videos]
         if ignored_videos:
             result['videos']['ignored'] = len(ignored_videos)
 
         if videos:
-            # download best subtitles
-            downloaded_subtitles = defaultdict(list)
-            with AsyncProviderPool(max_workers=max_workers, providers=providers, provider_configs=provider_configs) as p:
-                for video in videos:
-                    scores = get_scores(video)
-                    subtitles_to_download = p.list_subtitles(video, languages - video.subtitle_languages)
-                    downloaded_subtitles[video] = p.download_best_subtitles(subtitles_to_download, video, languages, min_score=scores['hash'] * min_score / 100)
-
-                if p.discarded_providers:
-                    result['providers']['discarded'] = list(p.discarded_providers)
-
-            # filter subtitles
-            with TinyDB('subtitle_db.json') as db:
-                table = db.table('downloaded')
-                query = Query()
-                for video, subtitles in downloaded_subtitles.items():
-                    discarded_subtitles = list()
-                    discarded_subtitles_info = list()
-
-                    for s in subtitles:
-                        subtitle_hash = hashlib.sha256(s.content).hexdigest()
-                        subtitle_file = get_subtitle_path(os.path.split(video.name)[1], s.language)
-                        dbo = {'hash': subtitle_hash, 'file': subtitle_file}
-                        if table.search((query.hash == subtitle_hash) & (query.file == subtitle_file)):
-                            discarded_subtitles.append(s)
-                            discarded_subtitles_info.append(dbo)
-                        else:
-                            table.insert(dbo)
-
-                    downloaded_subtitles[video] = [x for x in subtitles if x not in discarded_subtitles]
-                    if discarded_subtitles_info:
-                        result['subtitles']['discarded'] = result['subtitles'].get('discarded', []) + discarded_subtitles_info
-
-            downloaded_subtitles = {k: v for k,v in downloaded_subtitles.items() if v}
-
-            # save subtitles
-            saved_subtitles = {}
-            for video, subtitles in downloaded_subtitles.items():
-                saved_subtitles[video] = save_subtitles(video, subtitles, directory=None, encoding=encoding)
-
-                for key, group in groupby(saved_subtitles[video], lambda x: x.provider_name):
-                    subtitle_filenames = [get_subtitle_path(os.path.split(video.name)[1], s.language) for s in list(group)]
-                    result['subtitles'][key] = result['subtitles'].get(key, []) + subtitle_filenames
+            subtitle_filenames = defaultdict(list)
+            for video, subtitles in saved_subtitles.items():
+                for s in subtitles:
+                    subtitle_filenames[s.provider_name].append(get_subtitle_path(filenames[video], s.language))
+            for key, value in subtitle_filenames.items():
+                result['subtitles'].setdefault(key, []).extend(value)
             result['subtitles']['total'] = sum(len(v) for v in saved_subtitles.values())
 
             # refresh plex
-            for video, subtitles in saved_subtitles.items():
-                if plex and subtitles:
+            refreshed_videos = [v for v, s in saved_subtitles.items() if s]
+            if plex_url and plex_token and refreshed_videos:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                plex = PlexServer(plex_url, plex_token, session=session)
+
+                # search every section once per distinct title instead of once per video
+                titles = {
+                    'movie': dict((v.title.lower(), v.title) for v in refreshed_videos if isinstance(v, Movie)),
+                    'show': dict((v.series.lower(), v.series) for v in refreshed_videos if isinstance(v, Episode))
+                }
+                plex_index = []
+                for section in plex.library.sections():
+                    if isinstance(section, MovieSection):
+                        libtype = 'movie'
+                    elif isinstance(section, ShowSection):
+                        libtype = 'show'
+                    else:
+                        continue
+                    if not titles[libtype]:
+                        continue
+
+                    section_index = {}
+                    for key, title in titles[libtype].items():
+                        try:
+                            section_index[key] = section.search(title=title, libtype=libtype, sort='addedAt:desc')
+                        except BadRequest:
+                            continue
+                    plex_index.append((section, repr(section), section_index))
+
+                def find_plex_item(section_index, title, year):
+                    for item in section_index.get(title.lower(), []):
+                        if year is None or item.year == year:
+                            return item
+
+                episode_index = {}
+                indexed_seasons = set()
+                pending_refresh = defaultdict(list)
+                for video in refreshed_videos:
                     item_found = False
-                    for section in plex.library.sections():
+                    video_repr = repr(video)
+                    for section, section_repr, section_index in plex_index:
                         try:
                             if isinstance(section, MovieSection) and isinstance(video, Movie):
-                                results = section.search(title=video.title, year=video.year, libtype='movie', sort='addedAt:desc', maxresults=1)
-                                
-                                if not results:
-                                    raise NotFound
-
-                                plex_item = results[0]
+                                plex_items = [find_plex_item(section_index, video.title, video.year)]
                             elif isinstance(section, ShowSection) and isinstance(video, Episode):
-                                results = section.search(title=video.series, year=video.year, libtype='show', sort='addedAt:desc', maxresults=1)
-
-                                if not results:
-                                    raise NotFound
-
-                                plex_item = results[0].episode(season=video.season, episode=video.episode)
+                                plex_show = find_plex_item(section_index, video.series, video.year)
+                                # guessit gives a list of numbers for multi-episode files
+                                episodes = video.episode if isinstance(video.episode, list) else [video.episode]
+                                if not plex_show or not isinstance(video.season, int) or not all(isinstance(e, int) for e in episodes):
+                                    continue
+
+                                # only fetch the episodes of the season, once for all its videos
+                                if (plex_show.ratingKey, video.season) not in indexed_seasons:
+                                    indexed_seasons.add((plex_show.ratingKey, video.season))
+                                    for e in plex_show.season(video.season).episodes():
+                                        if e.index is not None:
+                                            episode_index[(plex_show.ratingKey, video.season, int(e.index))] = e
+
+                                plex_items = [episode_index.get((plex_show.ratingKey, video.season, e)) for e in episodes]
                             else:
                                 continue
                         except NotFound:
@@ -193,13 +339,24 @@ class ScanJob(job.JobBase):
                         except BadRequest:
                             continue
 
-                        if plex_item:
-                            plex_item.refresh()
-                            result['plex']['refreshed'] = result['plex'].get('refreshed', []) + ['%s%s' % (repr(plex_item.section()), repr(video))]
+                        # one entry per video and section, a multi-episode file refreshes all its episodes
+                        plex_items = [i for i in plex_items if i]
+                        if plex_items:
+                            pending_refresh[section.key].append((plex_items, '%s%s' % (section_repr, video_repr)))
                             item_found = True
 
                     if not item_found:
-                        result['plex']['failed'] = result['plex'].get('failed', []) + [repr(video)]
+                        result['plex'].setdefault('failed', []).append(video_repr)
+
+                # refresh section by section, each item once, over the kept-alive plex session
+                for section_key, items in pending_refresh.items():
+                    refreshed_items = set()
+                    for plex_items, refreshed in items:
+                        for plex_item in plex_items:
+                            if plex_item.ratingKey not in refreshed_items:
+                                plex_item.refresh()
+                                refreshed_items.add(plex_item.ratingKey)
+                        result['plex'].setdefault('refreshed', []).append(refreshed)
 
             # convert subtitles
             for video, subtitles in saved_subtitles.items():
@@ -210,8 +367,8 @@ class ScanJob(job.JobBase):
                     source_file = aeidon.files.new(source_format, subtitle_path, aeidon.encodings.detect_bom(subtitle_path) or encoding)
 
                     if source_format != target_format:
-                        format_info = {'file': get_subtitle_path(os.path.split(video.name)[1], s.language), 'from': source_format.label, 'to': target_format.label}
-                        result['subtitles']['converted'] = result['subtitles'].get('converted', []) + [format_info]
+                        format_info = {'file': get_subtitle_path(filenames[video], s.language), 'from': source_format.label, 'to': target_format.label}
+                        result['subtitles'].setdefault('converted', []).append(format_info)
 
                     aeidon_subtitles = source_file.read()
                     for f in [aeidon.formats.SUBRIP, aeidon.formats.MICRODVD, aeidon.formats.MPL2]:
@@ -226,8 +383,11 @@ class ScanJob(job.JobBase):
                     target_file = aeidon.files.new(target_format, subtitle_path, encoding)
                     target_file.write(aeidon_subtitles, aeidon.documents.MAIN)
 
-        scan_end = datetime.now()
-        result['meta']['start'] = scan_start.isoformat()
-        result['meta']['end'] = scan_end.isoformat()
-        result['meta']['duration'] = str(scan_end - scan_start)
-        return result
+        return _add_meta(result, scan_start)
+
+def _close_provider_pools():
+    for lease in ScanJob._pool_cache.values():
+        if lease['pool'] is not None:
+            lease['pool'].__exit__(None, None, None)
+
+atexit.register(_close_provider_pools)
@@ -0,0 +1,57 @@
+from datetime import datetime
+import logging
+import os
+
+from rarfile import NotRarFile, RarCannotExec
+
+from subliminal.core import ARCHIVE_EXTENSIONS, scan_archive, scan_video
+from subliminal.video import VIDEO_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+
+def iter_videos(path, age=None, archives=True):
+    """Scan `path` for videos and their subtitles, see :func:`subliminal.scan_videos`.
+
+    Unlike :func:`subliminal.scan_videos`, videos are yielded while the directory tree is walked.
+
+    :param str path: existing directory path to scan.
+    :param datetime.timedelta age: maximum age of the video or archive.
+    :param bool archives: scan videos in archives.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        # skip hidden sub directories
+        for dirname in list(dirnames):
+            if dirname.startswith('.'):
+                dirnames.remove(dirname)
+
+        for filename in filenames:
+            if not filename.endswith(VIDEO_EXTENSIONS + ARCHIVE_EXTENSIONS) or filename.startswith('.'):
+                continue
+
+            filepath = os.path.join(dirpath, filename)
+            if os.path.islink(filepath):
+                continue
+            try:
+                if age and datetime.utcnow() - datetime.utcfromtimestamp(os.path.getmtime(filepath)) > age:
+                    continue
+            except (ValueError, OverflowError):
+                logger.warning('Could not get age of file %r in %r', filename, dirpath)
+                continue
+
+            if filename.endswith(VIDEO_EXTENSIONS):
+                try:
+                    video = scan_video(filepath)
+                except ValueError:
+                    logger.exception('Error scanning video %r', filepath)
+                    continue
+            elif archives:
+                try:
+                    video = scan_archive(filepath)
+                except (NotRarFile, RarCannotExec, ValueError):
+                    logger.exception('Error scanning archive %r', filepath)
+                    continue
+            else:
+                continue
+
+            yield video
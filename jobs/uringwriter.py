@@ -0,0 +1,139 @@
+import os
+import platform
+import re
+
+from subliminal import save_subtitles
+from subliminal.subtitle import get_subtitle_path
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+
+def _kernel_version():
+    match = re.match(r'(\d+)\.(\d+)', platform.release())
+    return tuple(int(x) for x in match.groups()) if match else (0, 0)
+
+#: openat and close operations are only available since Linux 5.6
+URING_SUPPORTED = liburing is not None and platform.system() == 'Linux' and _kernel_version() >= (5, 6)
+
+
+class UringSubtitleWriter(object):
+    """:class:`UringSubtitleWriter` writes files with batched io_uring submissions.
+
+    Files added with :meth:`add` are written on :meth:`flush`, or as soon as a ring's worth of `entries` files is
+    pending: one submission opens the whole batch, one writes it and one closes it, instead of an open/write/close
+    syscall triple per file.
+    """
+    def __init__(self, entries=64):
+        self.entries = entries
+        self.pending = []
+        self.ring = liburing.io_uring()
+        self.cqe = liburing.io_uring_cqe()
+        liburing.io_uring_queue_init(entries, self.ring, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        liburing.io_uring_queue_exit(self.ring)
+
+    def add(self, path, data):
+        self.pending.append((path, data))
+        if len(self.pending) >= self.entries:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for i in range(0, len(pending), self.entries):
+            self._write_batch(pending[i:i + self.entries])
+
+    def _submit(self, prepare, items):
+        for index, item in enumerate(items):
+            sqe = liburing.io_uring_get_sqe(self.ring)
+            prepare(sqe, *item)
+            sqe.user_data = index
+        liburing.io_uring_submit(self.ring)
+
+        # completions can arrive in any order, user_data maps them back to their item
+        results = [None] * len(items)
+        for _ in items:
+            liburing.io_uring_wait_cqe(self.ring, self.cqe)
+            results[self.cqe.user_data] = self.cqe.res
+            liburing.io_uring_cqe_seen(self.ring, self.cqe)
+        return results
+
+    def _write_batch(self, batch):
+        flags = os.O_CREAT | os.O_WRONLY | os.O_TRUNC | os.O_CLOEXEC
+        # the kernel reads the paths on submit, they must stay referenced until then
+        paths = [(os.fsencode(path), ) for path, _ in batch]
+        fds = self._submit(lambda sqe, path: liburing.io_uring_prep_openat(sqe, path, flags, 0o666), paths)
+        opened = [(fd, path, data) for fd, (path, data) in zip(fds, batch) if fd >= 0]
+        written = self._submit(lambda sqe, fd, path, data: liburing.io_uring_prep_write(sqe, fd, data, len(data), 0),
+                               opened)
+        self._submit(lambda sqe, fd: liburing.io_uring_prep_close(sqe, fd), [(fd, ) for fd, _, _ in opened])
+
+        for fd, (path, data) in zip(fds, batch):
+            if fd < 0:
+                raise OSError(-fd, os.strerror(-fd), path)
+        for res, (_, path, data) in zip(written, opened):
+            if res < 0:
+                raise OSError(-res, os.strerror(-res), path)
+            if res != len(data):
+                raise IOError('Short write on \'%s\'' % path)
+
+
+def open_subtitle_writer():
+    """Open a :class:`UringSubtitleWriter`, or return ``None`` when io_uring is not available."""
+    if not URING_SUPPORTED:
+        return None
+    try:
+        return UringSubtitleWriter()
+    except OSError:
+        # io_uring can be disabled at runtime, e.g. by a seccomp profile
+        return None
+
+
+def batch_save_subtitles(downloaded_subtitles, single=False, directory=None, encoding=None, writer=None, flush=True):
+    """Save subtitles of many videos at once, see :func:`subliminal.save_subtitles`.
+
+    Subtitles are written with `writer` when given, with :func:`subliminal.save_subtitles` otherwise.
+    The writer is left open, so it can be reused for the next batch.
+
+    :param dict downloaded_subtitles: subtitles to save, by video.
+    :param writer: writer from :func:`open_subtitle_writer`.
+    :type writer: :class:`UringSubtitleWriter`
+    :param bool flush: flush `writer` before returning, otherwise files may be written by a later flush.
+    :return: the saved subtitles, by video.
+    :rtype: dict
+    """
+    if writer is None:
+        return {v: save_subtitles(v, s, single=single, directory=directory, encoding=encoding)
+                for v, s in downloaded_subtitles.items()}
+
+    saved_subtitles = {}
+    for video, subtitles in downloaded_subtitles.items():
+        saved_subtitles[video] = []
+        for subtitle in subtitles:
+            # same selection as subliminal.save_subtitles
+            if subtitle.content is None:
+                continue
+            if subtitle.language in set(s.language for s in saved_subtitles[video]):
+                continue
+
+            subtitle_path = get_subtitle_path(video.name, None if single else subtitle.language)
+            if directory is not None:
+                subtitle_path = os.path.join(directory, os.path.split(subtitle_path)[1])
+
+            writer.add(subtitle_path, subtitle.content if encoding is None else subtitle.text.encode(encoding))
+            saved_subtitles[video].append(subtitle)
+
+            if single:
+                break
+    if flush:
+        writer.flush()
+    return saved_subtitles